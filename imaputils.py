@@ -2,26 +2,259 @@
 # This work is licensed under GPL 3, see LICENSE
 # Author: Michael Walz <code@serpedon.de>, © 2016
 
-__all__ = ['scan_imap', 'store_imap_to_mbox', 'backup_imap']
+__all__ = ['scan_imap', 'scan_imap_iter', 'store_imap_to_mbox', 'backup_imap', 'enable_compression']
 
 import imaplib
 import email
+import email.parser
+import collections
+import contextlib
+import functools
+import concurrent.futures
+import threading
 import re
 import time
-list_response_pattern = re.compile(r'\((?P<flags>.*?)\) "(?P<delimiter>.*)" (?P<name>.*)')
+import zlib
+from email.utils import parsedate_to_datetime
+list_response_pattern = re.compile(rb'\((?P<flags>.*?)\) "(?P<delimiter>.*)" (?P<name>.*)')
+fetch_response_uid_pattern = re.compile(rb'\bUID (?P<uid>\d+)')
+throttle_response_pattern = re.compile(rb'\[(THROTTLED|THROTTLE|UNAVAILABLE|LIMIT|OVERQUOTA)\b', re.IGNORECASE)
+charset_pattern = re.compile(r'charset="[^"]*"')
+message_id_strip_pattern = re.compile(r'[<>% ]')
+header_parser = email.parser.BytesHeaderParser()
+
+# number of messages which are addressed by a single UID FETCH/STORE command
+bulk_size = 100
+# number of UID FETCH commands which are sent without awaiting their responses
+pipeline_depth = 8
+# default number of concurrent connections of scan_imap (servers usually limit the connections per IP)
+max_connections = 4
+# number of retries of a throttled command (with delays of 1s, 2s, 4s, ...)
+max_throttle_retries = 6
 
 
 def parse_list_response(line):
+    """ Parses a line (bytes) of the LIST response; only the mailbox name is decoded to a string. """
     flags, delimiter, mailbox_name = list_response_pattern.match(line).groups()
-    mailbox_name = mailbox_name.strip('"')
+    mailbox_name = mailbox_name.decode('utf-8').strip('"')
     return (flags, delimiter, mailbox_name)
 
+def split_into_batches(uids, size = bulk_size) :
+    """ Splits a list of uids into batches of at most size uids. """
+    return [ uids[i:i+size] for i in range(0, len(uids), size) ]
+
+def parse_fetch_response(data) :
+    """
+        Parses the data returned by imap4.uid('fetch', ...) and returns a dictionary
+        which maps the uid (bytes) of each message to its fetched literal (bytes).
+        The UID item may be located in front of or behind the literal.
+    """
+    fetched = {}
+    literal = None
+    for item in data :
+        if item is None : continue
+        if isinstance(item, tuple) :
+            descriptor, literal = item
+        else :
+            descriptor = item
+        match = fetch_response_uid_pattern.search(descriptor)
+        if match and literal is not None :
+            fetched[match.group('uid')] = literal
+            literal = None
+    return fetched
+
+def is_throttled(result, data) :
+    """ Tests if the response of a command indicates that the server throttles the client. """
+    return result == 'NO' and any(isinstance(line, bytes) and throttle_response_pattern.search(line) for line in data)
+
+def uid_with_backoff(imap4, command, *args) :
+    """
+        Issues imap4.uid(command, *args) and retries it with exponential backoff
+        (starting at 1s) as long as the server responds that it throttles the client.
+    """
+    delay = 1
+    result, data = imap4.uid(command, *args)
+    for retry in range(max_throttle_retries) :
+        if not is_throttled(result, data) : break
+        time.sleep(delay)
+        delay *= 2
+        result, data = imap4.uid(command, *args)
+    return result, data
+
+def fetch_imap(imap4, uids, message_parts) :
+    """
+        Fetches message_parts of all messages with the given uids in the selected mailbox
+        using a single UID FETCH command; message_parts has to request the UID item,
+            e.g. message_parts = '(UID BODY.PEEK[HEADER])'
+        Returns a dictionary which maps each uid (bytes) to the fetched literal (bytes).
+    """
+    result, data = uid_with_backoff(imap4, 'fetch', b','.join(uids), message_parts)
+    if not result == 'OK' : raise RuntimeError(f'imap4.uid(fetch, ...): {result}')
+    return parse_fetch_response(data)
+
+def retire_pending_fetches(imap4, pending) :
+    """
+        Awaits the tagged responses of all pipelined commands in pending (a deque of tuples (batch, tag))
+        and discards the untagged FETCH responses, so that they are not returned by a later command.
+    """
+    while pending :
+        batch, tag = pending.popleft()
+        try :
+            imap4._command_complete('UID', tag)
+        except imap4.abort :
+            raise
+        except imap4.error :
+            pass
+    imap4.untagged_responses.pop('FETCH', None)
+
+def store_imap(imap4, uids, store_command) :
+    """ Issues store_command on all messages with the given uids in the selected mailbox using a single UID STORE command. """
+    result, data = uid_with_backoff(imap4, 'store', b','.join(uids), store_command[0], store_command[1])
+    if not result == 'OK' : raise RuntimeError(f'imap4.uid(store, ..., {store_command}): {result}') 
+
+def paced_store_and_fetch(imap4, uids, store_command, message_parts, sleep_after_x_messages, sleep_duration) :
+    """
+        Issues store_command (if not None) and fetches message_parts (if not None) for batches of at most
+        sleep_after_x_messages uids, one command at a time (no pipelining), and makes a sleep of sleep_duration
+        seconds all sleep_after_x_messages messages to prevent connection loses on overload-protected-connections.
+        Yields a tuple (batch, fetched) for each batch like pipelined_fetch (fetched is empty if message_parts is None).
+    """
+    message_counter = 0
+    for batch in split_into_batches(uids, min(bulk_size, sleep_after_x_messages)) :
+        if store_command is not None :
+            store_imap(imap4, batch, store_command)
+        yield batch, fetch_imap(imap4, batch, message_parts) if message_parts is not None else {}
+
+        previous_counter = message_counter
+        message_counter += len(batch)
+        if message_counter // sleep_after_x_messages > previous_counter // sleep_after_x_messages :
+            time.sleep(sleep_duration)
+
+def pipelined_fetch(imap4, batches, message_parts, depth = pipeline_depth) :
+    """
+        Fetches message_parts of all batches of uids in the selected mailbox.
+        Up to depth UID FETCH commands are sent to the server without awaiting their
+        responses (pipelining, see RFC 3501, section 5.5).
+        Yields a tuple (batch, fetched) for each batch in the given order, where fetched
+        is the dictionary returned by parse_fetch_response.
+        If a pipelined command fails, the remaining batches are fetched sequentially by fetch_imap.
+        No other command may be issued on imap4 while the generator is suspended; if it is closed early,
+        the commands in flight are retired, so that the connection can be used afterwards.
+    """
+    remaining = collections.deque(batches)
+    pending = collections.deque()
+    fetched = {}
+    try :
+        while remaining or pending :
+            while remaining and len(pending) < depth :
+                batch = remaining.popleft()
+                pending.append( (batch, imap4._command('UID', 'FETCH', b','.join(batch), message_parts)) )
+
+            batch, tag = pending.popleft()
+            try :
+                result, data = imap4._command_complete('UID', tag)
+            except imap4.abort :
+                raise
+            except imap4.error :
+                result = 'BAD'
+
+            if not result == 'OK' :
+                # retire all commands in flight and fall back to sequential mode
+                fallback = [ batch ] + [ batch for batch, tag in pending ] + list(remaining)
+                retire_pending_fetches(imap4, pending)
+                for batch in fallback :
+                    yield batch, fetch_imap(imap4, batch, message_parts)
+                return
+
+            # the untagged responses may already contain messages of subsequent batches
+            result, data = imap4._untagged_response(result, data, 'FETCH')
+            fetched.update(parse_fetch_response(data))
+            yield batch, { num : fetched.pop(num) for num in batch if num in fetched }
+    finally :
+        # commands are only left in flight if the generator is closed early (or failed)
+        if pending :
+            try :
+                retire_pending_fetches(imap4, pending)
+            except imap4.abort :
+                pass
+
+class InflatingFile :
+    """
+        Minimal file-like object which inflates the data read from raw_file,
+        as needed by imaplib (read, readline, close) after COMPRESS DEFLATE.
+    """
+    def __init__(self, raw_file) :
+        self.raw_file = raw_file
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = bytearray()
+
+    def fill(self) :
+        """ Appends inflated data to the buffer; returns False at the end of the stream. """
+        while True :
+            chunk = self.raw_file.read1(65536)
+            if not chunk : return False
+            data = self.decompressor.decompress(chunk)
+            if data :
+                self.buffer += data
+                return True
+
+    def read(self, size) :
+        while len(self.buffer) < size and self.fill() : pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, limit = -1) :
+        end = self.buffer.find(b'\n')
+        while end < 0 and (limit < 0 or len(self.buffer) < limit) and self.fill() :
+            end = self.buffer.find(b'\n')
+        end = len(self.buffer) if end < 0 else end + 1
+        if 0 <= limit < end : end = limit
+        return self.read(end)
+
+    def close(self) :
+        self.raw_file.close()
+
+def enable_compression(imap4) :
+    """
+        Enables compression of the connection (COMPRESS=DEFLATE, see RFC 4978) if supported by the server.
+        imap4 is an IMAP4-instance with performed login.
+        Returns True if compression is enabled, False otherwise.
+    """
+    result, data = imap4.capability()
+    if not result == 'OK' or 'COMPRESS=DEFLATE' not in data[-1].decode('ascii').upper().split() :
+        return False
+
+    imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+    result, data = imap4._simple_command('COMPRESS', 'DEFLATE')
+    if not result == 'OK' : return False
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+    sock = imap4.sock
+    def send(data) :
+        sock.sendall(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))
+    imap4.send = send
+    imap4.file = InflatingFile(imap4.file)
+    return True
+
+def get_uid_validity(imap4) :
+    """ Returns the UIDVALIDITY (string) reported by the server for the just selected mailbox or None. """
+    result, data = imap4.response('UIDVALIDITY')
+    return data[0].decode('ascii') if data[0] else None
+
+@functools.lru_cache(maxsize=4096)
+def format_date(date) :
+    """
+        Returns the tuple (fulldate, year) of strings for the value of a Date header.
+        The results are cached, since Date headers of messages in threads and digests often repeat.
+    """
+    dateObj = parsedate_to_datetime(date)
+    return (dateObj.strftime("%Y-%m-%d_%H.%M_utc%z"), dateObj.strftime("%Y"))
+
 def clean(string) :
-    if type(string) == type(str()) :
-        return string.strip()
-    return string
+    return string.strip() if isinstance(string, str) else string
 
-def scan_imap(imap4, imap_search, store_command = None, return_found_msg = True, return_only_headers = True, mailbox_name = None, ignore_mailboxes = set(), sleep_after_x_messages = 100, sleep_duration = 30) : 
+def scan_imap(imap4, imap_search, store_command = None, return_found_msg = True, return_only_headers = True, mailbox_name = None, ignore_mailboxes = set(), sleep_after_x_messages = 100, sleep_duration = 30, n_connections = None, connection_factory = None, throttle_mode = 'adaptive') : 
     """
         The method scannes an imap-mailbox for messages.
 
@@ -39,64 +272,145 @@ def scan_imap(imap4, imap_search, store_command = None, return_found_msg = True,
             e.g. store_command = ('+FLAGS', '\\Flagged') # to flag all found messages
 
         If return_found_msg == True, the function returns a list of all messages which match imap_search
-            each message is represented by a dictionary with keys: 'Folder', 'Id', 'From', 'To', 'Subject', 'Date'
+            each message is represented by a dictionary with keys: 'Folder', 'Uid', 'UidValidity', 'Id', 'From', 'To', 'Subject', 'Date'
+            ('Uid' is only valid as long as the UIDVALIDITY of the folder equals 'UidValidity')
     
         If return_only_headers == True, the returned message contains only the headers (default).
         If return_only_headers == False, the full messages is also returned via the key 'Message'
+        and its raw bytes (as received from the server) via the key 'RawBytes'
         (return_only_headers is only evaluated when return_found_msg == True is set)
 
         mailbox_name is the name of an imap folder which can be given to imap4.select(mailbox_name).
         If set to None (default), the scan is performed for all imap folders.
 
-        ignore_mailboxes is a set of names (strings) which specify the mailboxes which are ignore while scanning.
+        ignore_mailboxes is a set (or any other iterable) of names (strings) which specify the mailboxes which are ignore while scanning.
         The default is an empty set.
 
-        sleep_after_x_messages specifies the number of passed messages after which a delay of sleep_duration seconds is included to prevent connection loses on overload-protected-connections. The default is a 30s sleep duration after 100 messages.
+        throttle_mode specifies how overload-protected-connections are handled:
+            'adaptive' (default): commands are only delayed (with exponential backoff) when the server responds that it throttles the client.
+            'fixed': additionally, after sleep_after_x_messages passed messages a delay of sleep_duration seconds is included to prevent connection loses.
+        sleep_after_x_messages and sleep_duration are only evaluated for throttle_mode == 'fixed'. The default is a 30s sleep duration after 100 messages.
+
+        connection_factory is a callable which returns a new IMAP4-instance with performed login.
+            e.g. def connection_factory() :
+                     imap4 = imaplib.IMAP4_SSL("imap.example.com", 993)
+                     imap4.login("username","password")
+                     return imap4
+        If given, the mailboxes are scanned concurrently with up to n_connections additional connections
+        (default: max_connections), which are logged out afterwards; imap4 is then only used to list the mailboxes.
+        If connection_factory is None (default) or n_connections == 1, all mailboxes are scanned sequentially via imap4.
+
+        See scan_imap_iter for a variant which yields the found messages one by one.
         
     """
 
-    foundMsg = []
+    foundMsg = list(scan_imap_iter(imap4, imap_search, store_command, return_found_msg, return_only_headers, mailbox_name, ignore_mailboxes, sleep_after_x_messages, sleep_duration, n_connections, connection_factory, throttle_mode))
 
-    if mailbox_name is not None :
-        mailbox_list = [ b'() "." ' + mailbox_name.encode('utf-8') ]
-    else :
-        result, mailbox_list = imap4.list()
-        if not result == 'OK' : raise RuntimeError('imap4.list(): ' + result) 
-    
-    for mailbox in mailbox_list:
-        (flags, delimiter, mailbox_name) = parse_list_response(mailbox.decode('utf-8'))
+    if return_found_msg :
+        return foundMsg
 
-        if mailbox_name in ignore_mailboxes : continue
+def scan_imap_iter(imap4, imap_search, store_command = None, return_found_msg = True, return_only_headers = True, mailbox_name = None, ignore_mailboxes = set(), sleep_after_x_messages = 100, sleep_duration = 30, n_connections = None, connection_factory = None, throttle_mode = 'adaptive') : 
+    """
+        Generator variant of scan_imap (with the same parameters), which yields the found messages
+        one by one instead of collecting them in a list, i.e. the memory usage does not grow with their number.
+        In sequential mode, no other command may be issued on imap4 while the generator is suspended;
+        it is safe to stop early (by close() or a break out of a for loop), the connection can be used afterwards.
+        With a connection_factory, the messages of each mailbox are collected before they are yielded.
+        The parameters are validated on the call, not on the first iteration.
+    """
 
-        result, data = imap4.select('"' + mailbox_name + '"', readonly=(store_command is None))
-        if not result == 'OK' : raise RuntimeError('imap4.select(' + mailbox_name + '): ' + result) 
+    if throttle_mode not in ('adaptive', 'fixed') : raise ValueError(f'unknown throttle_mode: {throttle_mode}')
+    ignore_mailboxes = frozenset(ignore_mailboxes)
 
-        result, data = imap4.uid('search', None, imap_search)
-        if not result == 'OK' : raise RuntimeError("imap4.uid(search, ...) in " + mailbox_name + '): ' + result)
+    scan_args = (imap_search, store_command, return_found_msg, return_only_headers, sleep_after_x_messages if throttle_mode == 'fixed' else None, sleep_duration)
 
-        message_counter = 0
-        for num in data[0].split():
-            message_counter = message_counter + 1
-            if store_command is not None :
-                result, data = imap4.uid('store', num, store_command[0], store_command[1])
-                if not result == 'OK' : raise RuntimeError('imap4.uid(store, ' + str(num) + ', ' + store_command + '): ' + result) 
+    def generate_found_msg(mailbox_name) :
+        if mailbox_name is not None :
+            mailbox_name = mailbox_name.strip('"') # as parse_list_response does for names of the LIST response
+            mailbox_names = [ mailbox_name ] if mailbox_name not in ignore_mailboxes else []
+        else :
+            result, mailbox_list = imap4.list()
+            if not result == 'OK' : raise RuntimeError(f'imap4.list(): {result}') 
 
-            if return_found_msg :
-                result, data = imap4.uid('fetch', num, '(BODY[HEADER])' if return_only_headers else '(RFC822)') # '(BODY[HEADER])' reads only the headers; '(RFC822)' loads the whole message
-                if not result == 'OK' : raise RuntimeError("imap4.uid(fetch, ...) in " + mailbox_name + '): ' + result) 
+            mailbox_names = []
+            for mailbox in mailbox_list:
+                (flags, delimiter, mailbox_name) = parse_list_response(mailbox)
 
-                email_message = email.message_from_bytes(data[0][1])
-                Message = None if return_only_headers else email_message
-                foundMsg.append( dict(Folder=mailbox_name, Id=clean(email_message['Message-ID']), From=clean(email_message['From']), To=clean(email_message['To']), Subject=clean(email_message['Subject']), Date=clean(email_message['Date']), Message=Message) )
+                if mailbox_name in ignore_mailboxes : continue
 
-            # make a sleep all sleep_after_x_messages messages to prevent connection loses on overload-protected-connections
-            if message_counter % sleep_after_x_messages == 0 :
-                time.sleep(sleep_duration)
+                mailbox_names.append(mailbox_name)
 
-    if return_found_msg :
-        return foundMsg
+        if connection_factory is None or n_connections == 1 :
+            for mailbox_name in mailbox_names :
+                yield from scan_mailbox(imap4, mailbox_name, *scan_args)
+        else :
+            # imaplib connections are not thread-safe, hence every worker thread uses its own connection
+            connections = []
+            thread_data = threading.local()
+            def scan_with_own_connection(mailbox_name) :
+                if not hasattr(thread_data, 'imap4') :
+                    thread_data.imap4 = connection_factory()
+                    connections.append(thread_data.imap4)
+                return list(scan_mailbox(thread_data.imap4, mailbox_name, *scan_args))
+
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=n_connections or max_connections)
+            try :
+                for msgs in executor.map(scan_with_own_connection, mailbox_names) :
+                    yield from msgs
+            finally :
+                # do not scan the remaining mailboxes if the consumer stopped early (or a scan failed)
+                executor.shutdown(wait=True, cancel_futures=True)
+                for connection in connections :
+                    try :
+                        connection.logout()
+                    except (imaplib.IMAP4.error, OSError) :
+                        pass
+
+    return generate_found_msg(mailbox_name)
 
-def backup_imap(imap4, backup_folder, deleted_folder = '_deleted', ignore_mailboxes=set()) :
+def scan_mailbox(imap4, mailbox_name, imap_search, store_command, return_found_msg, return_only_headers, sleep_after_x_messages, sleep_duration) :
+    """
+        Performs the scan of scan_imap for a single mailbox and yields the found messages.
+        If sleep_after_x_messages is None, the messages are fetched by pipelined_fetch without fixed delays;
+        otherwise, they are stored and fetched by paced_store_and_fetch.
+    """
+
+    result, data = imap4.select(f'"{mailbox_name}"', readonly=(store_command is None))
+    if not result == 'OK' : raise RuntimeError(f'imap4.select({mailbox_name}): {result}') 
+    uid_validity = get_uid_validity(imap4)
+
+    result, data = uid_with_backoff(imap4, 'search', None, imap_search)
+    if not result == 'OK' : raise RuntimeError(f'imap4.uid(search, ...) in {mailbox_name}: {result}')
+
+    # '(BODY.PEEK[HEADER])' reads only the headers; '(RFC822)' loads the whole message
+    message_parts = '(UID BODY.PEEK[HEADER])' if return_only_headers else '(UID RFC822)'
+
+    uids = data[0].split()
+
+    if sleep_after_x_messages is None :
+        if store_command is not None :
+            for batch in split_into_batches(uids) :
+                store_imap(imap4, batch, store_command)
+        if not return_found_msg : return
+        fetches = pipelined_fetch(imap4, split_into_batches(uids), message_parts)
+    else :
+        fetches = paced_store_and_fetch(imap4, uids, store_command, message_parts if return_found_msg else None, sleep_after_x_messages, sleep_duration)
+
+    _clean = clean # local binding for the per-message loop
+    # (closing the generator explicitly retires pipelined commands in flight if this generator is closed early)
+    with contextlib.closing(fetches) :
+        for batch, fetched in fetches :
+            for num in batch :
+                if num in fetched :
+                    if return_only_headers :
+                        email_message = header_parser.parsebytes(fetched[num])
+                    else :
+                        email_message = email.message_from_bytes(fetched[num])
+                    Message = None if return_only_headers else email_message
+                    RawBytes = None if return_only_headers else fetched[num]
+                    yield dict(Folder=mailbox_name, Uid=num.decode(), UidValidity=uid_validity, Id=_clean(email_message['Message-ID']), From=_clean(email_message['From']), To=_clean(email_message['To']), Subject=_clean(email_message['Subject']), Date=_clean(email_message['Date']), Message=Message, RawBytes=RawBytes)
+
+def backup_imap(imap4, backup_folder, deleted_folder = '_deleted', ignore_mailboxes=set(), n_connections = None, connection_factory = None, reserialize_messages = False, compress = False) :
     """
         The method backups an imap-mailbox to local disk.
 
@@ -114,6 +428,14 @@ def backup_imap(imap4, backup_folder, deleted_folder = '_deleted', ignore_mailbo
 
         ignore_mailboxes is a set of names (strings) which specify the mailboxes which are not backuped.
         The default is an empty set.
+
+        n_connections and connection_factory are passed to scan_imap to scan the mailboxes concurrently.
+
+        If reserialize_messages == False (default), messages are stored as received from the server
+        (with line endings converted to '\n'). If reserialize_messages == True, messages are parsed
+        and written by email.generator.BytesGenerator (with repair of broken messages by fix_cte).
+
+        If compress == True, the connection imap4 is compressed by enable_compression (if supported by the server).
     """
 
     # imports
@@ -122,12 +444,9 @@ def backup_imap(imap4, backup_folder, deleted_folder = '_deleted', ignore_mailbo
     # helper functions
     def gen_filename(mail_dict) :
         """ Generates a filename from a dictionary with keys 'Id', 'Date', 'Folder' """
-        from email.utils import parsedate_to_datetime
-        dateObj = parsedate_to_datetime(mail_dict['Date'])
-        fulldate = dateObj.strftime("%Y-%m-%d_%H.%M_utc%z")
-        year = dateObj.strftime("%Y")
+        fulldate, year = format_date(mail_dict['Date'])
 
-        Id = mail_dict['Id'].replace('<', '').replace('>', '').replace('%', '').replace('/', '-').replace(' ', '')
+        Id = message_id_strip_pattern.sub('', mail_dict['Id']).replace('/', '-')
 
         Folder = mail_dict['Folder'].replace(' ', '_')
 
@@ -138,14 +457,27 @@ def backup_imap(imap4, backup_folder, deleted_folder = '_deleted', ignore_mailbo
         if not os.path.exists(folder) :
             os.makedirs(folder)
 
+    directory_contents = {}
+    def list_directory(directory) :
+        """ Returns the set of filenames in a directory (which is created if necessary); cached per directory. """
+        if directory not in directory_contents :
+            create_dir_if_not_exist(directory)
+            with os.scandir(directory) as entries :
+                directory_contents[directory] = { entry.name for entry in entries }
+        return directory_contents[directory]
+
     def  fix_cte(message) :
         """
-            Cycles through all internal messages, tests if they are convertable to string,
+            Walks once through all internal messages, tests if the non-multipart parts are convertable to string,
             and if not (because of a KeyError) adds the field 'content-transfer-encoding'.
+            (Multipart containers are not tested themselves, since this would convert all their subparts again.)
         """
-        if message.is_multipart() :
-            for payload in message.get_payload() :
-                fix_cte(payload)
+        for part in message.walk() :
+            if not part.is_multipart() :
+                fix_cte_of_part(part)
+
+    def fix_cte_of_part(message) :
+        """ Tests if a single message part is convertable to string and repairs it if not. """
         try :
             string = str(message)
         except KeyError as err :
@@ -158,60 +490,90 @@ def backup_imap(imap4, backup_folder, deleted_folder = '_deleted', ignore_mailbo
                 print('Fixing payload: removing charset from content-type')
                 contentType = message['content-type']
                 del message['content-type']
-                message['content-type'] = re.sub(r'charset="[^"]*"', r'', contentType).strip()
+                message['content-type'] = charset_pattern.sub('', contentType).strip()
 
                    
+    if compress : enable_compression(imap4)
+
     # Search for all messages that are not deleted
-    allMsgHeaders = scan_imap(imap4, imap_search="(Undeleted)", ignore_mailboxes=ignore_mailboxes)
+    # (the headers are processed one by one; only the new messages are kept until they are downloaded,
+    #  since the download needs the connection which is busy while the scan is running)
+    allMsgHeaders = scan_imap_iter(imap4, imap_search="(Undeleted)", ignore_mailboxes=ignore_mailboxes, n_connections=n_connections, connection_factory=connection_factory)
 
     msg_already_existing = 0
     msg_downloaded = 0
 
     paths_of_all_msg = set()
 
-    # Download new messages (if not available locally)
+    # Determine new messages (if not available locally) grouped by folder
+    new_msgs = collections.defaultdict(list)
     for msg in allMsgHeaders:
-        from email import generator
         filename = gen_filename(msg)
         full_path = os.path.join(backup_folder, filename)
         directory = os.path.dirname(full_path)
         if full_path in paths_of_all_msg :
             print('Warning: %s has been found multiple times on the server' % filename)
             continue	
-        paths_of_all_msg |= { full_path }
-        create_dir_if_not_exist(directory)
-        if os.path.exists(full_path) :
+        paths_of_all_msg.add(full_path)
+        if os.path.basename(full_path) in list_directory(directory) :
             msg_already_existing += 1
         else :
             msg_downloaded += 1
             print('%s is new on server --> downloading' % (filename))
-            full_msgs = scan_imap(imap4, imap_search="(Header Message-ID \"" + msg['Id'] + "\")", return_only_headers = False, mailbox_name = msg['Folder'])
-            for full_msg in full_msgs :
-                filename2 = gen_filename(full_msg)
-                if not (filename == filename2) : raise RuntimeError('Error: filenames do not match: ' + filename + ' ; ' + filename2) 
+            new_msgs[msg['Folder']].append( (dict(Uid=msg['Uid'], UidValidity=msg['UidValidity'], Id=msg['Id']), filename, full_path) )
+
+    # Download new messages folder by folder using the uids of the initial scan
+    from email import generator
+    for mailbox_name, msgs in new_msgs.items() :
+        result, data = imap4.select(f'"{mailbox_name}"', readonly=True)
+        if not result == 'OK' : raise RuntimeError(f'imap4.select({mailbox_name}): {result}') 
+
+        uid_validity = get_uid_validity(imap4)
+
+        targets = {}
+        for msg, filename, full_path in msgs :
+            if msg['UidValidity'] == uid_validity :
+                targets[msg['Uid'].encode()] = (filename, full_path)
+                continue
+            # the uids have been reassigned since the scan, search the message again by its Message-ID
+            result, data = uid_with_backoff(imap4, 'search', None, f'(Header Message-ID "{msg["Id"]}")')
+            if not result == 'OK' : raise RuntimeError(f'imap4.uid(search, ...) in {mailbox_name}: {result}')
+            for num in data[0].split()[:1] :
+                targets[num] = (filename, full_path)
+
+        for batch, fetched in pipelined_fetch(imap4, split_into_batches(list(targets)), '(UID RFC822)') :
+            for num in batch :
+                if num not in fetched : continue
+                filename, full_path = targets[num]
+                raw = fetched[num]
+                message = email.message_from_bytes(raw) if reserialize_messages else header_parser.parsebytes(raw)
+                filename2 = gen_filename(dict(Folder=mailbox_name, Id=clean(message['Message-ID']), Date=clean(message['Date'])))
+                if not (filename == filename2) : raise RuntimeError(f'Error: filenames do not match: {filename} ; {filename2}') 
 
                 full_path_tilde = full_path + '~'
-                with open(full_path_tilde, 'w', errors="surrogateescape") as outfile :
-                    message = full_msg['Message']
-                    gen = generator.Generator(outfile, mangle_from_=False)
-                    try :
-                        gen.flatten(message)
-                    except (KeyError, UnicodeEncodeError) :
-                        fix_cte(message)
-                        gen.flatten(message)
+                with open(full_path_tilde, 'wb', buffering=1<<20) as outfile :
+                    if not reserialize_messages :
+                        outfile.write(raw.replace(b'\r\n', b'\n'))
+                    else :
+                        gen = generator.BytesGenerator(outfile, mangle_from_=False)
+                        try :
+                            gen.flatten(message)
+                        except (KeyError, UnicodeEncodeError) :
+                            fix_cte(message)
+                            gen.flatten(message)
                        
                 os.rename(full_path_tilde, full_path)
-                break
 
 
     # Update local list of paths of all messages with all parent directories
-    for path in list(paths_of_all_msg) :
-        dirname = path
-        old_dirname = None
-        while dirname != old_dirname :
-            old_dirname = dirname
+    # (each ancestor is visited only once, since the walk stops at the first known one)
+    parent_dirs = set()
+    for path in paths_of_all_msg :
+        dirname = os.path.dirname(path)
+        while dirname and dirname not in parent_dirs :
+            parent_dirs.add(dirname)
             dirname = os.path.dirname(dirname)
-            paths_of_all_msg |= { dirname }
+    paths_of_all_msg |= parent_dirs
 
     # Move all file in 'deleted'-subdirectories which do not exist on the imap-server anymore
     msg_keeping = 0
@@ -219,10 +581,13 @@ def backup_imap(imap4, backup_folder, deleted_folder = '_deleted', ignore_mailbo
     def move_deleted_messages(folder) :
         nonlocal msg_keeping
         nonlocal msg_move_to_deleted
-        for filename in os.listdir(folder) :
-            if filename != deleted_folder :
-                full_path = os.path.join(folder, filename)
-                if os.path.isdir(full_path) :
+        with os.scandir(folder) as entries :
+            entries = list(entries)
+        for entry in entries :
+            if entry.name != deleted_folder :
+                filename = entry.name
+                full_path = entry.path
+                if entry.is_dir() :
                     move_deleted_messages(full_path)
                 else : 
                     if full_path in paths_of_all_msg :
@@ -246,25 +611,25 @@ def backup_imap(imap4, backup_folder, deleted_folder = '_deleted', ignore_mailbo
     print("Consistency check: A+B==C; %d+%d==%d; %s" % (msg_downloaded,msg_already_existing,msg_keeping, 'SUCCESS' if msg_downloaded+msg_already_existing==msg_keeping else 'FAILED'))
 
 
-def store_imap_to_mbox(imap4, directory) : 
+def store_imap_to_mbox(imap4, directory, compress = False) : 
+    if compress : enable_compression(imap4)
+
     result, mailbox_list = imap4.list()
-    if not result == 'OK' : raise RuntimeError('imap4.list(): ' + result) 
+    if not result == 'OK' : raise RuntimeError(f'imap4.list(): {result}') 
 
     from mailbox import mbox
     for mailbox in mailbox_list:
-        (flags, delimiter, mailbox_name) = parse_list_response(mailbox.decode('utf-8'))
+        (flags, delimiter, mailbox_name) = parse_list_response(mailbox)
         
         mbox_file = mbox(directory + '/' + mailbox_name)
 
-        result, data = imap4.select('"' + mailbox_name + '"', readonly=True)
-        if not result == 'OK' : raise RuntimeError('imap4.select(' + mailbox_name + '): ' + result)
-
-        result, data = imap4.uid('search', None, '(UNDELETED)' )
-        if not result == 'OK' : raise RuntimeError("imap4.uid(search, ...) in " + mailbox_name + '): ' + result)
-
-        for num in data[0].split():
-            result, data = imap4.uid('fetch', num, '(RFC822)') # '(RFC822)' loads the whole message
-            if not result == 'OK' : raise RuntimeError("imap4.uid(fetch, ...) in " + mailbox_name + '): ' + result) 
+        result, data = imap4.select(f'"{mailbox_name}"', readonly=True)
+        if not result == 'OK' : raise RuntimeError(f'imap4.select({mailbox_name}): {result}')
 
-            mbox_file.add(data[0][1])
+        result, data = uid_with_backoff(imap4, 'search', None, '(UNDELETED)' )
+        if not result == 'OK' : raise RuntimeError(f'imap4.uid(search, ...) in {mailbox_name}: {result}')
 
+        for batch, fetched in pipelined_fetch(imap4, split_into_batches(data[0].split()), '(UID RFC822)') : # '(RFC822)' loads the whole message
+            for num in batch :
+                if num in fetched :
+                    mbox_file.add(fetched[num])